@@ -5,8 +5,622 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
+import array
+import bisect
+import collections
+import hashlib
 import logging
+import math
+import mmap
+import os
+import pickle
 import re
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+# G1 parameter tokens, compiled once for the preprocessing scan
+_Z_RE = re.compile(rb'Z([-+]?[0-9]*\.?[0-9]+)')
+_E_RE = re.compile(rb'E([-+]?[0-9]*\.?[0-9]+)')
+
+# Read size for streaming the G-code file during preprocessing
+_READ_CHUNK_SIZE = 1 << 20
+
+# Any comment that is a marker we track contains one of these
+_MARKER_RE = re.compile(rb';(?:LAYER_CHANGE|LAYER:|Z:|HEIGHT:|layer_height|TYPE:)')
+_HEIGHT_PREFIXES = (b';HEIGHT:', b';layer_height')
+_MARKER_PREFIXES = (b';LAYER:', b';Z:') + _HEIGHT_PREFIXES
+# Line starts the bulk G1 count cannot take at face value: G10, G11, ...
+# (to be left out) and lines with leading whitespace (which it would miss)
+_ODD_LINE_RE = re.compile(rb'\n(?:G1[0-9]|[ \t\r\x0b\x0c])')
+# One match per G1 line, capturing its E value (empty when it has none);
+# E words without a number are skipped like _E_RE.search() would
+_G1_E_RE = re.compile(rb'\n[^\S\n]*G1(?![0-9])'
+                      rb'(?:[^;\nE]*E(?![-+]?[0-9]*\.?[0-9]))*'
+                      rb'[^;\nE]*(?:E([-+]?[0-9]*\.?[0-9]+))?')
+# The same without the skipping, for spans where every E has a number (a
+# span without _BARE_E_RE matches), which is the common case
+_G1_FIRST_E_RE = re.compile(rb'\n[^\S\n]*G1(?![0-9])'
+                            rb'[^;\nE]*(?:E([-+]?[0-9]*\.?[0-9]+))?')
+_BARE_E_RE = re.compile(rb'E(?![-+]?[0-9]*\.?[0-9])')
+
+# A ;TYPE: marker naming an inner wall feature (see _is_inner_type())
+_INNER_TYPE_RE = re.compile(rb';TYPE:[^\n]*?(?i:inner)')
+
+# Preprocessing cache: bump the version whenever TransformTable changes
+# or the scan would produce a different table for the same file
+_CACHE_VERSION = 16
+_CACHE_MAX_ENTRIES = 16
+
+
+# One transform point, as returned by TransformTable lookups (the table
+# itself stores the fields column-wise)
+TransformInfo = collections.namedtuple(
+    'TransformInfo', ('brick_z', 'e', 'layer', 'offset_state', 'type'))
+
+def _read_blocks(filename):
+    """
+    Yield a file as raw byte blocks of whole lines. The file is
+    memory-mapped and cut into blocks of about _READ_CHUNK_SIZE bytes
+    that end on a newline, so each block is copied out of the page cache
+    exactly once (no text decoding, no per-line buffered IO).
+    """
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            # mmap refuses empty files
+            return
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Not every file can be mapped (e.g. on some network or FUSE
+            # mounts); read those in blocks instead
+            yield from _read_blocks_buffered(f)
+            return
+        with mm:
+            dontneed = None
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                dontneed = getattr(mmap, 'MADV_DONTNEED', None)
+            pos = released = 0
+            while pos < size:
+                end = pos + _READ_CHUNK_SIZE
+                if end < size:
+                    nl = mm.rfind(b'\n', pos, end)
+                    if nl < 0:
+                        # A line longer than the block size
+                        nl = mm.find(b'\n', end)
+                    end = size if nl < 0 else nl + 1
+                else:
+                    end = size
+                block = mm[pos:end]
+                pos = end
+                yield block
+                # Unmap the pages already scanned: they stay in the page
+                # cache, but the scan's resident set no longer grows
+                # with the file size
+                if dontneed is not None:
+                    done = end - end % mmap.PAGESIZE
+                    if done > released:
+                        mm.madvise(dontneed, released, done - released)
+                        released = done
+
+def _read_blocks_buffered(f):
+    """Yield blocks of whole lines from an open binary file"""
+    tail = b''
+    while True:
+        data = f.read(_READ_CHUNK_SIZE)
+        if not data:
+            break
+        if tail:
+            data = tail + data
+        nl = data.rfind(b'\n')
+        if nl < 0:
+            # Inside a line longer than the block size
+            tail = data
+            continue
+        tail = data[nl + 1:]
+        yield data[:nl + 1]
+    if tail:
+        yield tail
+
+def _is_inner_type(feature_type):
+    """
+    Return whether moves of a feature type get transformed. Look for
+    "inner" in the name to catch:
+    - "Internal perimeter" (PrusaSlicer)
+    - "Inner wall" (Bambu Studio)
+    - "Internal perimeters" (SuperSlicer)
+    - "WALL-INNER" (Cura - lowercase conversion catches this)
+    """
+    return 'inner' in feature_type.lower()
+
+def _has_inner_feature(filename):
+    """
+    Return whether any ;TYPE: marker in a file names an inner wall feature.
+    A False result means a scan would find nothing to transform.
+    
+    The file is searched block by block through _read_blocks(), which
+    releases the pages it has passed, so checking a large file without
+    inner walls does not map all of it into the resident set.
+    """
+    search = _INNER_TYPE_RE.search
+    for block in _read_blocks(filename):
+        if search(block):
+            return True
+    return False
+
+class TransformTable:
+    """
+    Transform points for a preprocessed file, stored as parallel arrays.
+    
+    Rows are appended in G1 command order. Each row holds the brick layer
+    Z, the E value parsed from the G-code line with extrusion_multiplier
+    already applied (NaN when the move has no E), and the layer metadata
+    used for status reporting. The layer (with its offset state) and the
+    feature type (only needed for verbose logs) change only at marker
+    comments, so they are kept per run of rows: `layer_rows` and
+    `type_rows` hold the first row of each run, `layers`, `layer_offsets`
+    and `type_ids` its values (the latter an index into `type_names`,
+    since a file only uses a handful). The brick Z is only
+    kept formatted as a G1 parameter (`z_params`), which is all the
+    runtime needs; a print only uses a few hundred distinct Z values, so
+    rows share one string object per value (pooled in `z_strings`). G1
+    numbers are 32-bit (a print would need billions of moves to overflow
+    them), which keeps a row at 12 bytes plus the Z string reference.
+    
+    G1 commands are executed in increasing order, so the runtime walks
+    the rows with a cursor instead of looking each command up: `next_g1`
+    is the G1 number of the next transform point (sys.maxsize once all
+    have been passed), and every command below it is a pass-through that
+    costs one integer compare. There is no per-G1 index to store.
+    """
+    
+    # next_g1 is read for every G1 executed; slots keep that a fixed
+    # offset load (and pickling handles slotted objects natively)
+    __slots__ = ('extrusion_multiplier', 'cursor', 'skipped', 'next_g1',
+                 'g1_nums', 'z_params', 'z_strings', 'e', 'layer_rows',
+                 'layers', 'layer_offsets', 'type_rows', 'type_ids',
+                 'type_names')
+    
+    def __init__(self, extrusion_multiplier=1.):
+        self.extrusion_multiplier = extrusion_multiplier  # Applied to e
+        self.cursor = 0
+        self.skipped = 0  # Rows the cursor passed without applying them
+        self.next_g1 = sys.maxsize
+        self.g1_nums = array.array('I')
+        self.z_params = []
+        self.z_strings = {}
+        self.e = array.array('d')
+        self.layer_rows = array.array('I')
+        self.layers = array.array('I')
+        self.layer_offsets = array.array('B')
+        self.type_rows = array.array('I')
+        self.type_ids = array.array('H')
+        self.type_names = []
+    
+    def add(self, g1_num, brick_z, e, layer, offset_state, feature_type):
+        """Append a transform point; g1_num must be increasing"""
+        if not self.g1_nums:
+            self.next_g1 = g1_num
+        self.g1_nums.append(g1_num)
+        self.z_params.append(self._z_param(brick_z))
+        self.e.append(math.nan if e is None else e)
+        self._mark_layer(layer, offset_state, 1)
+        self._mark_run(self.type_rows, self.type_ids,
+                       self._type_id(feature_type), 1)
+    
+    def add_run(self, first_g1, brick_z, es, layer, offset_state,
+                feature_type):
+        """
+        Append transform points for consecutive G1 commands starting at
+        first_g1 that share everything but E (NaN when absent)
+        """
+        count = len(es)
+        if not count:
+            return
+        if not self.g1_nums:
+            self.next_g1 = first_g1
+        self.g1_nums.extend(range(first_g1, first_g1 + count))
+        self.z_params.extend([self._z_param(brick_z)] * count)
+        self.e.extend(es)
+        self._mark_layer(layer, offset_state, count)
+        self._mark_run(self.type_rows, self.type_ids,
+                       self._type_id(feature_type), count)
+    
+    def _z_param(self, brick_z):
+        z_param = "%.6f" % (brick_z,)
+        return self.z_strings.setdefault(z_param, z_param)
+    
+    def _mark_run(self, rows, values, value, count):
+        # Start a new run unless the last count rows continue the last one
+        if not values or values[-1] != value:
+            rows.append(len(self.g1_nums) - count)
+            values.append(value)
+    
+    def _mark_layer(self, layer, offset_state, count):
+        # Like _mark_run(), with the offset state riding along the layer
+        layers = self.layers
+        if (not layers or layers[-1] != layer
+                or self.layer_offsets[-1] != offset_state):
+            self.layer_rows.append(len(self.g1_nums) - count)
+            layers.append(layer)
+            self.layer_offsets.append(offset_state)
+    
+    def _type_id(self, feature_type):
+        names = self.type_names
+        try:
+            return names.index(feature_type)
+        except ValueError:
+            names.append(feature_type)
+            return len(names) - 1
+    
+    def layer(self, row):
+        """Return the layer of a row"""
+        return self.layers[bisect.bisect_right(self.layer_rows, row) - 1]
+    
+    def offset_state(self, row):
+        """Return the brick offset state of a row"""
+        run = bisect.bisect_right(self.layer_rows, row) - 1
+        return bool(self.layer_offsets[run])
+    
+    def type_name(self, row):
+        """Return the feature type of a row"""
+        run = bisect.bisect_right(self.type_rows, row) - 1
+        return self.type_names[self.type_ids[run]]
+    
+    def __len__(self):
+        return len(self.g1_nums)
+    
+    def set_extrusion_multiplier(self, multiplier):
+        """Rescale the pre-multiplied E values to a new multiplier"""
+        if multiplier == self.extrusion_multiplier:
+            return
+        if self.extrusion_multiplier:
+            ratio = multiplier / self.extrusion_multiplier
+            self.e = array.array('d', [v * ratio for v in self.e])
+        else:
+            # Nothing to rescale from; NaN makes the runtime scale E itself
+            self.e = array.array('d', [math.nan]) * len(self.e)
+        self.extrusion_multiplier = multiplier
+    
+    def seek(self, g1_num):
+        """
+        Advance the cursor past g1_num and return its row, or -1 when it
+        is not transformed. g1_num must not decrease between calls and
+        must be at least next_g1.
+        """
+        g1_nums = self.g1_nums
+        count = len(g1_nums)
+        row = self.cursor
+        if row < count and g1_nums[row] != g1_num:
+            # Catch up after commands that skipped the lookup (disabled)
+            row = bisect.bisect_left(g1_nums, g1_num, row)
+        found = row < count and g1_nums[row] == g1_num
+        self.skipped += row - self.cursor
+        if found:
+            row += 1
+        self.cursor = row
+        self.next_g1 = g1_nums[row] if row < count else sys.maxsize
+        return row - 1 if found else -1
+    
+    def rewind(self):
+        """Move the cursor back to the first row for a new print"""
+        self.cursor = 0
+        self.skipped = 0
+        self.next_g1 = self.g1_nums[0] if self.g1_nums else sys.maxsize
+    
+    def applied(self):
+        """Return the number of rows the cursor has applied"""
+        return self.cursor - self.skipped
+    
+    def layer_reached(self):
+        """Return the layer of the last row the cursor passed, or 0"""
+        cursor = self.cursor
+        return self.layer(cursor - 1) if cursor else 0
+    
+    def row(self, g1_num):
+        """Return the row for a G1 command number, or -1"""
+        g1_nums = self.g1_nums
+        row = bisect.bisect_left(g1_nums, g1_num)
+        if row < len(g1_nums) and g1_nums[row] == g1_num:
+            return row
+        return -1
+    
+    def __contains__(self, g1_num):
+        return self.row(g1_num) >= 0
+    
+    def upcoming(self, g1_num, count):
+        """Return up to count transformed G1 numbers after g1_num"""
+        g1_nums = self.g1_nums
+        start = bisect.bisect_right(g1_nums, g1_num)
+        return g1_nums[start:start + count].tolist()
+    
+    def __getitem__(self, g1_num):
+        """Return the TransformInfo for a G1 command (debug/status use)"""
+        row = self.row(g1_num)
+        if row < 0:
+            raise KeyError(g1_num)
+        e = self.e[row]
+        return TransformInfo(float(self.z_params[row]),
+                             None if math.isnan(e) else e,
+                             self.layer(row), self.offset_state(row),
+                             self.type_name(row))
+    
+    def keys(self):
+        return self.g1_nums
+
+def _parse_z(code):
+    """
+    Return the Z word of a G1 command (without its comment), or None.
+    
+    The value ends at the first byte that is not part of a plain decimal,
+    as in Klipper's own parser; float() on the whole token would read a
+    packed "Z1E2" as 100 (an exponent), so always go through the regex.
+    """
+    z_match = _Z_RE.search(code)
+    return float(z_match.group(1)) if z_match else None
+
+def _z_pieces(block, start, end):
+    """
+    Split the lines in block[start:end] into (start, end, has_z) ranges,
+    giving each line that contains a 'Z' byte a range of its own.
+    block[start - 1] must be a newline.
+    """
+    while start < end:
+        z_pos = block.find(b'Z', start, end)
+        if z_pos < 0:
+            yield start, end, False
+            return
+        line_start = block.rfind(b'\n', start - 1, z_pos) + 1
+        if line_start > start:
+            yield start, line_start, False
+        line_end = block.find(b'\n', z_pos, end) + 1 or end
+        yield line_start, line_end, True
+        start = line_end
+
+def _last_move_z(block, start, end):
+    """
+    Return the Z set by the last G1 in block[start:end], or None.
+    
+    Searches backwards from the last 'Z' byte, so a span with no Z words
+    costs a single rfind. block[start - 1] must be a newline.
+    """
+    while True:
+        end = block.rfind(b'Z', start, end)
+        if end < 0:
+            return None
+        line_start = block.rfind(b'\n', start - 1, end) + 1
+        line_end = block.find(b'\n', end)
+        if line_end < 0:
+            line_end = len(block)
+        line = block[line_start:line_end].lstrip()
+        if line[:2] == b'G1' and not line[2:3].isdigit():
+            z = _parse_z(line.partition(b';')[0])
+            if z is not None:
+                return z
+        end = line_start
+
+def _scan_gcode(blocks, start_layer, extrusion_multiplier, verbose):
+    """
+    Classify G-code (raw bytes, in blocks of whole lines) and collect the
+    transform points.
+    
+    Almost nothing needs per-line work. The marker comments are found
+    with a regex search, and the stretches between them are handled in
+    bulk: outside transformed features G1 commands are counted with
+    bytes.count() and only the last Z set is parsed; inside them one
+    regex pass collects the E values of each run of moves between Z
+    words. G-code is ASCII, so only feature type names get decoded.
+    Returns (table, g1_count, feature_type_seen).
+    """
+    table = TransformTable(extrusion_multiplier)
+    layer = 0
+    current_type = None
+    is_inner = False
+    brick_offset_state = False
+    current_z = 0.0
+    layer_height = 0.2  # Default
+    g1_count = 0  # Count G1 commands during preprocessing
+    feature_type_seen = collections.Counter()  # Feature types we see
+    known_types = {}  # Raw ;TYPE: line -> (decoded name, is_inner)
+    lines_before = 0  # File lines in earlier blocks (for verbose logs)
+    
+    # Bound once: the loops below call these per span or per line
+    marker_search = _MARKER_RE.search
+    g1_e_findall = _G1_E_RE.findall
+    g1_first_e_findall = _G1_FIRST_E_RE.findall
+    bare_e_search = _BARE_E_RE.search
+    odd_line_findall = _ODD_LINE_RE.findall
+    e_search = _E_RE.search
+    table_add = table.add
+    add_run = table.add_run
+    nan = math.nan
+    
+    for block in blocks:
+        # With a newline in front of every line, b'\nG1' finds each G1
+        block = b'\n' + block
+        size = len(block)
+        pos = 1
+        while pos < size:
+            # Find the next marker line; a marker token in any other line
+            # (e.g. a G1 with a trailing comment) does not count
+            marker = None
+            search_pos = pos
+            while True:
+                marker_match = marker_search(block, search_pos)
+                if marker_match is None:
+                    end = line_end = size
+                    break
+                end = block.rfind(b'\n', pos - 1, marker_match.start()) + 1
+                line_end = block.find(b'\n', marker_match.end())
+                if line_end < 0:
+                    line_end = size
+                line_stripped = block[end:line_end].strip()
+                if line_stripped[:1] == b';' and (
+                        b';LAYER_CHANGE' in line_stripped
+                        or b';TYPE:' in line_stripped
+                        or line_stripped.startswith(_MARKER_PREFIXES)):
+                    marker = line_stripped
+                    break
+                search_pos = line_end
+            
+            # The moves up to the marker. G10/G11 are not moves; Klipper
+            # dispatches them to other handlers.
+            transform = is_inner and layer >= start_layer
+            odd_lines = None
+            if not transform and end > pos:
+                odd_lines = odd_line_findall(block, pos - 1, end)
+                if any(line[1:2] != b'G' for line in odd_lines):
+                    # Indented lines: count the moves one by one
+                    odd_lines = None
+            if end <= pos:
+                pieces = ()
+            elif odd_lines is not None:
+                # Nothing to transform and no indented lines: count the
+                # G1s and keep just the last Z
+                g1_count += (block.count(b'\nG1', pos - 1, end)
+                             - len(odd_lines))
+                z = _last_move_z(block, pos, end)
+                if z is not None:
+                    current_z = z
+                pieces = ()
+            elif transform and not (verbose and len(table) < 10):
+                # Only lines with a Z word (e.g. Z hops) need parsing one
+                # by one; the moves between them share one brick Z
+                pieces = _z_pieces(block, pos, end)
+            else:
+                pieces = ((pos, end, True),)
+            
+            for piece_start, piece_end, per_line in pieces:
+                if not per_line:
+                    # Every move shares one brick Z and only E differs;
+                    # one regex pass collects the E of each G1 line
+                    if bare_e_search(block, piece_start, piece_end):
+                        values = g1_e_findall(block, piece_start - 1,
+                                              piece_end)
+                    else:
+                        values = g1_first_e_findall(block, piece_start - 1,
+                                                    piece_end)
+                    es = [float(v) * extrusion_multiplier if v else nan
+                          for v in values]
+                    add_run(g1_count + 1, current_z + (layer_height / 2.0),
+                            es, layer, brick_offset_state, current_type)
+                    g1_count += len(es)
+                    continue
+                
+                for line_num, line in enumerate(
+                        block[piece_start:piece_end].split(b'\n'), 1):
+                    if line[:2] != b'G1':
+                        # Only indented lines need trimming; trailing
+                        # whitespace never reaches the parameter search
+                        line = line.lstrip()
+                        if line[:2] != b'G1':
+                            continue
+                    if line[2:3].isdigit():
+                        continue
+                    
+                    # Increment G1 counter (THIS IS THE KEY FIX)
+                    g1_count += 1
+                    
+                    # Strip any trailing comment before looking at parameters
+                    code = line.partition(b';')[0]
+                    
+                    # Extract Z from the actual G1 command if present
+                    if b'Z' in code:
+                        z = _parse_z(code)
+                        if z is not None:
+                            current_z = z
+                    
+                    if not transform:
+                        continue
+                    
+                    # Calculate brick layer Z (half layer height offset)
+                    brick_z = current_z + (layer_height / 2.0)
+                    
+                    # E is only needed for moves we transform
+                    extrude = None
+                    if b'E' in code:
+                        e_match = e_search(code)
+                        if e_match:
+                            extrude = (float(e_match.group(1))
+                                       * extrusion_multiplier)
+                    
+                    # Store transform point keyed by G1 command number
+                    table_add(g1_count, brick_z, extrude, layer,
+                              brick_offset_state, current_type)
+                    
+                    if verbose and len(table) <= 10:
+                        line_num += (lines_before
+                                     + block.count(b'\n', 1, piece_start))
+                        logging.info("BrickLayers: Marked G1 command #%d "
+                                     "for transformation (file line %d, "
+                                     "layer %d, type: %s, Z: %.3f -> %.3f)",
+                                     g1_count, line_num, layer, current_type,
+                                     current_z, brick_z)
+            
+            if marker is None:
+                break
+            pos = line_end + 1
+            line_stripped = marker
+            
+            # Track layer changes (common in most slicers)
+            if b';LAYER_CHANGE' in line_stripped or line_stripped.startswith(b';LAYER:'):
+                layer += 1
+                # Alternate brick offset state each layer (after start_layer)
+                if layer >= start_layer:
+                    brick_offset_state = not brick_offset_state
+                
+                if verbose:
+                    logging.info("BrickLayers: Layer %d (offset_state=%s)",
+                                 layer, brick_offset_state)
+                continue
+            
+            # Track Z height from comments (PrusaSlicer/OrcaSlicer style)
+            if line_stripped.startswith(b';Z:'):
+                try:
+                    current_z = float(line_stripped[3:])
+                except ValueError:
+                    pass
+                continue
+            
+            # Track layer height from comments
+            if line_stripped.startswith(_HEIGHT_PREFIXES):
+                try:
+                    layer_height = float(
+                        line_stripped.partition(b':')[2].split(None, 1)[0])
+                    if verbose:
+                        logging.info("BrickLayers: Detected layer height: %smm",
+                                     layer_height)
+                except (ValueError, IndexError):
+                    pass
+                continue
+            
+            # Track feature type (critical for identifying inner walls!).
+            # Slicers repeat the same few ;TYPE: lines throughout the file,
+            # so the whole line is the cache key
+            type_info = known_types.get(line_stripped)
+            if type_info is None:
+                # (the marker guarantees a ':', so partition always splits)
+                type_name = line_stripped.partition(b':')[2].strip()
+                current_type = type_name.decode('ascii', 'replace')
+                # Decide once per type line whether its moves get
+                # transformed, so no G1 line repeats the check
+                type_info = known_types[line_stripped] = (
+                    current_type, _is_inner_type(current_type))
+            current_type, is_inner = type_info
+            
+            # Track what types we see for debugging
+            feature_type_seen[current_type] += 1
+            
+            if verbose:
+                logging.info("BrickLayers: Feature type: %s", current_type)
+        
+        lines_before += block.count(b'\n', 1)
+    
+    return table, g1_count, feature_type_seen
 
 class BrickLayers:
     """
@@ -24,8 +638,22 @@ class BrickLayers:
         start_layer: 3                  # Start applying after this layer
         require_slicer_comments: True   # Require TYPE comments in G-code
         verbose: False                  # Log all transformations to console
+        cache_dir: ~/.klipper_brick_cache  # Preprocessing cache (empty = off)
     """
     
+    # Fixed attribute layout: the G1 wrapper reads several of these on every
+    # move, and slot access skips the per-instance __dict__ probe
+    __slots__ = (
+        'printer', 'gcode', 'name',
+        'enabled', 'z_offset', 'extrusion_multiplier', 'start_layer',
+        'require_comments', 'verbose', 'cache_dir',
+        'transform_map', 'g1_command_count',
+        'last_preprocessed_file', '_preprocess_done',
+        '_preprocess_generation', '_table_lock',
+        '_moves_total_closed', '_enabled_since',
+        'sdcard', 'original_work_handler', 'original_cmd_G1',
+    )
+    
     def __init__(self, config):
         self.printer = config.get_printer()
         self.gcode = self.printer.lookup_object('gcode')
@@ -38,16 +666,27 @@ class BrickLayers:
         self.start_layer = config.getint('start_layer', 3)
         self.require_comments = config.getboolean('require_slicer_comments', True)
         self.verbose = config.getboolean('verbose', False)
+        cache_dir = config.get('cache_dir', '~/.klipper_brick_cache')
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
         
         # Runtime state
-        self.current_layer = 0
-        self.transform_map = {}          # Maps G1 command number -> transform info
+        self.transform_map = TransformTable(self.extrusion_multiplier)
         self.g1_command_count = 0        # Counts G1 commands during execution
         self.last_preprocessed_file = None
+        self._preprocess_done = threading.Event()
+        self._preprocess_generation = 0  # Latest requested scan
+        self._table_lock = threading.Lock()  # Guards table and scan generation
         
-        # Statistics
-        self.stats_moves_transformed = 0
-        self.stats_moves_total = 0
+        # Hooks, installed in _handle_ready()
+        self.sdcard = None
+        self.original_work_handler = None
+        self.original_cmd_G1 = None
+        
+        # Statistics are derived from the G1 count and the transform cursor
+        # (see stats_moves_total/stats_moves_transformed), so the wrapper
+        # does not keep counters
+        self._moves_total_closed = 0  # Moves seen in past enabled periods
+        self._enabled_since = 0       # G1 count when last enabled
         
         # Register G-code commands
         self.gcode.register_command(
@@ -90,10 +729,11 @@ class BrickLayers:
             # Hook into the work handler to detect file loads
             self.original_work_handler = self.sdcard.work_handler
             self.sdcard.work_handler = self._work_handler_wrapper
-        except:
+        except Exception as e:
+            # lookup_object() raises config_error when the section is missing
             self.sdcard = None
-            logging.warning("BrickLayers: virtual_sdcard not found, "
-                          "preprocessing will be disabled")
+            logging.warning("BrickLayers: virtual_sdcard not available (%s), "
+                            "preprocessing will be disabled", e)
         
         # Hook into gcode_move for G1 interception
         try:
@@ -102,6 +742,11 @@ class BrickLayers:
             
             # Store original G1 handler
             self.original_cmd_G1 = self.gcode.register_command('G1', None)
+            if self.original_cmd_G1 is None:
+                # Transformed moves are rewritten in place and handed to
+                # the original handler; without one there is nothing to
+                # wrap (and re-dispatching G1 text would recurse into us)
+                raise RuntimeError("no G1 handler registered")
             
             # Register our wrapper
             self.gcode.register_command('G1', self._cmd_G1_wrapper,
@@ -115,18 +760,33 @@ class BrickLayers:
     
     def cmd_ENABLE(self, gcmd):
         """Enable brick layering"""
+        multiplier = gcmd.get_float('EXTRUSION_MULTIPLIER',
+                                    self.extrusion_multiplier, above=0.)
+        with self._table_lock:
+            self.extrusion_multiplier = multiplier
+            # E values in the loaded map are pre-multiplied; rescale them
+            # in place rather than rescanning the file
+            self.transform_map.set_extrusion_multiplier(multiplier)
+        if not self.enabled:
+            self._enabled_since = self.g1_command_count
         self.enabled = True
         gcmd.respond_info("BrickLayers: ENABLED")
         logging.info("BrickLayers enabled via command")
         
-        # If we have a loaded file but no transform map, preprocess now
-        if self.sdcard and hasattr(self.sdcard, 'file_path') and self.sdcard.file_path():
-            if not self.transform_map:
-                gcmd.respond_info("BrickLayers: Preprocessing current file...")
-                self._preprocess_gcode_file(self.sdcard.file_path())
+        # If we have a loaded file but no transform map, preprocess it in
+        # the background; a synchronous scan would stall the reactor
+        file_path = self.sdcard.file_path() if self.sdcard else None
+        if file_path and not self.transform_map and not self._preprocess_running():
+            gcmd.respond_info("BrickLayers: Preprocessing current file in "
+                              "the background...")
+            self._start_preprocessing(file_path)
+            self.last_preprocessed_file = file_path
     
     def cmd_DISABLE(self, gcmd):
         """Disable brick layering"""
+        if self.enabled:
+            self._moves_total_closed += (self.g1_command_count
+                                         - self._enabled_since)
         self.enabled = False
         gcmd.respond_info("BrickLayers: DISABLED")
         logging.info("BrickLayers disabled via command")
@@ -136,6 +796,7 @@ class BrickLayers:
         status = (
             f"BrickLayers Status:\n"
             f"  Enabled: {self.enabled}\n"
+            f"  Preprocessing: {'running' if self._preprocess_running() else 'idle'}\n"
             f"  Current Layer: {self.current_layer}\n"
             f"  Z Offset: {self.z_offset}mm\n"
             f"  Extrusion Multiplier: {self.extrusion_multiplier}\n"
@@ -148,12 +809,7 @@ class BrickLayers:
         
         if self.verbose and self.transform_map:
             # Show next few upcoming transforms
-            upcoming = []
-            for cmd_num in sorted(self.transform_map.keys()):
-                if cmd_num > self.g1_command_count:
-                    upcoming.append(cmd_num)
-                    if len(upcoming) >= 5:
-                        break
+            upcoming = self.transform_map.upcoming(self.g1_command_count, 5)
             if upcoming:
                 gcmd.respond_info(f"  Next transforms at G1 commands: {upcoming}")
     
@@ -163,13 +819,17 @@ class BrickLayers:
             gcmd.respond_info("BrickLayers: No virtual_sdcard available")
             return
         
-        if not hasattr(self.sdcard, 'file_path') or not self.sdcard.file_path():
+        file_path = self.sdcard.file_path()
+        if not file_path:
             gcmd.respond_info("BrickLayers: No file currently loaded")
             return
         
-        gcmd.respond_info(f"BrickLayers: Reprocessing {self.sdcard.file_path()}...")
-        self._preprocess_gcode_file(self.sdcard.file_path())
-        gcmd.respond_info("BrickLayers: Reload complete")
+        gcmd.respond_info(f"BrickLayers: Reprocessing {file_path}...")
+        # Scan in the background so a large file does not stall the
+        # reactor; bypass the cache, so a bad cached table gets replaced
+        self._start_preprocessing(file_path, use_cache=False)
+        gcmd.respond_info("BrickLayers: Reload started, see "
+                          "BRICK_LAYERS_STATUS for progress")
     
     def get_status(self, eventtime):
         """Return status for Moonraker/Mainsail integration"""
@@ -181,244 +841,314 @@ class BrickLayers:
             'start_layer': self.start_layer,
             'g1_commands_executed': self.g1_command_count,
             'transform_points': len(self.transform_map),
+            'preprocessing': self._preprocess_running(),
             'moves_transformed': self.stats_moves_transformed,
             'moves_total': self.stats_moves_total,
         }
     
     def _work_handler_wrapper(self, eventtime):
         """Wrapper for virtual_sdcard work handler to detect file loads"""
-        # Check if a new file was loaded
-        if hasattr(self.sdcard, 'file_path') and self.sdcard.file_path():
-            if self.sdcard.file_path() != self.last_preprocessed_file:
-                if self.enabled:
-                    logging.info(f"BrickLayers: New file detected: {self.sdcard.file_path()}")
-                    self._preprocess_gcode_file(self.sdcard.file_path())
-                self.last_preprocessed_file = self.sdcard.file_path()
+        # The handler runs from the start of the file for a new print and
+        # from where it stopped on resume. Printing the same file again
+        # (after it finished or was cancelled) keeps its table but must
+        # count G1 commands from the start
+        if self.sdcard.file_position == 0:
+            self._reset_print_state()
+        
+        # Check if a new file was loaded (last_preprocessed_file starts out
+        # as None, so this is a single compare)
+        file_path = self.sdcard.file_path()
+        if file_path and file_path != self.last_preprocessed_file:
+            logging.info("BrickLayers: New file detected: %s", file_path)
+            self._start_preprocessing(file_path)
+            self.last_preprocessed_file = file_path
         
         # Call original handler
         return self.original_work_handler(eventtime)
     
-    def _preprocess_gcode_file(self, filename):
+    def _reset_print_state(self):
+        """Reset runtime counters for a new print"""
+        self.transform_map.rewind()
+        self.g1_command_count = 0
+        self._moves_total_closed = 0
+        self._enabled_since = 0
+    
+    @property
+    def current_layer(self):
+        """Layer of the transform point the print has last reached"""
+        return self.transform_map.layer_reached()
+    
+    @property
+    def stats_moves_transformed(self):
+        """Transformed moves executed"""
+        return self.transform_map.applied()
+    
+    @property
+    def stats_moves_total(self):
+        """G1 commands executed while enabled"""
+        total = self._moves_total_closed
+        if self.enabled:
+            total += self.g1_command_count - self._enabled_since
+        return total
+    
+    def _preprocess_running(self):
+        return self._preprocess_generation > 0 and not self._preprocess_done.is_set()
+    
+    def _start_preprocessing(self, filename, use_cache=True):
+        """
+        Scan a newly loaded file in a background thread.
+        
+        The reactor keeps dispatching G1 commands (and counting them) while
+        the scan runs; moves pass through untransformed until the finished
+        table is published. The first start_layer layers are never
+        transformed, which leaves plenty of time for the scan to complete.
+        
+        The G1 count is left alone: it only restarts with a new print (see
+        _work_handler_wrapper()), and rows are numbered from the start of
+        the file, so a table published mid-print (ENABLE after a failed
+        scan, RELOAD) has its cursor catch up to the running count.
+        """
+        # Under the lock, so a superseded scan finishing now cannot
+        # publish its table (or mark this scan done) in between
+        with self._table_lock:
+            self.transform_map = TransformTable(self.extrusion_multiplier)
+            self._preprocess_done.clear()
+            self._preprocess_generation += 1
+            generation = self._preprocess_generation
+        thread = threading.Thread(target=self._preprocess_gcode_file,
+                                  args=(filename, generation, use_cache),
+                                  name="brick_layers-preprocess", daemon=True)
+        thread.start()
+    
+    def _publish_table(self, table, generation):
+        """Install a finished table unless a newer scan has been requested"""
+        with self._table_lock:
+            if generation != self._preprocess_generation:
+                logging.info("BrickLayers: Discarding result of superseded "
+                             "scan")
+                return
+            # Pick up an EXTRUSION_MULTIPLIER change made during the scan
+            table.set_extrusion_multiplier(self.extrusion_multiplier)
+            # A single attribute store, so the G1 wrapper never sees a
+            # partially built table
+            self.transform_map = table
+            self._preprocess_done.set()
+    
+    def _preprocess_gcode_file(self, filename, generation=None,
+                               use_cache=True):
         """
         Scan G-code file and build transformation map.
-        This runs ONCE when a print file is loaded.
+        This runs ONCE when a print file is loaded, either inline or from
+        the background thread started by _start_preprocessing().
+        With use_cache=False the file is rescanned even when a cached
+        table exists, and the cache entry is overwritten.
         
         Key fix: We count G1 COMMANDS, not file lines, so the numbering
         matches what we'll see during execution.
         """
-        import time
-        
-        self.transform_map = {}
-        self.g1_command_count = 0  # Reset for new file
-        self.current_layer = 0     # Reset for new file
-        self.stats_moves_transformed = 0
-        self.stats_moves_total = 0
+        if generation is None:
+            with self._table_lock:
+                self._preprocess_generation += 1
+                generation = self._preprocess_generation
         
-        # Preprocessing state
-        layer = 0
-        current_type = None
-        brick_offset_state = False
-        current_z = 0.0
-        layer_height = 0.2  # Default
-        g1_count = 0  # Count G1 commands during preprocessing
+        # Reuse the result of an earlier scan of this exact file
+        cache_path = self._cache_path(filename)
+        table = self._load_cached_table(cache_path) if use_cache else None
+        if table is not None:
+            logging.info("BrickLayers: Loaded %d transform points "
+                         "for %s from cache", len(table), filename)
+            self._publish_table(table, generation)
+            return
         
-        logging.info(f"BrickLayers: Preprocessing {filename}")
+        logging.info("BrickLayers: Preprocessing %s", filename)
         start_time = time.time()
-        
-        feature_type_seen = {}  # Track what feature types we see
+        extrusion_multiplier = self.extrusion_multiplier
         
         try:
-            with open(filename, 'r') as f:
-                for line_num, line in enumerate(f, 1):
-                    line_stripped = line.strip()
-                    
-                    # Track layer changes (common in most slicers)
-                    if ';LAYER_CHANGE' in line_stripped or line_stripped.startswith(';LAYER:'):
-                        layer += 1
-                        # Alternate brick offset state each layer (after start_layer)
-                        if layer >= self.start_layer:
-                            brick_offset_state = not brick_offset_state
-                        
-                        if self.verbose:
-                            logging.info(f"BrickLayers: Layer {layer} "
-                                       f"(offset_state={brick_offset_state})")
-                        continue
-                    
-                    # Track Z height from comments (PrusaSlicer/OrcaSlicer style)
-                    if line_stripped.startswith(';Z:'):
-                        try:
-                            current_z = float(line_stripped.split(':')[1])
-                        except (ValueError, IndexError):
-                            pass
-                        continue
-                    
-                    # Track layer height from comments
-                    if line_stripped.startswith(';HEIGHT:') or line_stripped.startswith(';layer_height'):
-                        try:
-                            layer_height = float(line_stripped.split(':')[1].split()[0])
-                            if self.verbose:
-                                logging.info(f"BrickLayers: Detected layer height: {layer_height}mm")
-                        except (ValueError, IndexError):
-                            pass
-                        continue
-                    
-                    # Track feature type (critical for identifying inner walls!)
-                    if ';TYPE:' in line_stripped:
-                        try:
-                            current_type = line_stripped.split(':', 1)[1].strip()
-                            
-                            # Track what types we see for debugging
-                            feature_type_seen[current_type] = feature_type_seen.get(current_type, 0) + 1
-                            
-                            if self.verbose:
-                                logging.info(f"BrickLayers: Feature type: {current_type}")
-                        except IndexError:
-                            pass
-                        continue
-                    
-                    # Check if this is a G1 move command
-                    if line_stripped.startswith('G1'):
-                        # Increment G1 counter (THIS IS THE KEY FIX)
-                        g1_count += 1
-                        
-                        # Extract Z from the actual G1 command if present
-                        if 'Z' in line_stripped:
-                            z_match = re.search(r'Z([-+]?[0-9]*\.?[0-9]+)', line_stripped)
-                            if z_match:
-                                current_z = float(z_match.group(1))
-                        
-                        # Determine if this move should be transformed
-                        # Look for "inner" in the type name to catch:
-                        # - "Internal perimeter" (PrusaSlicer)
-                        # - "Inner wall" (Bambu Studio)
-                        # - "Internal perimeters" (SuperSlicer)
-                        # - "WALL-INNER" (Cura - lowercase conversion catches this)
-                        is_inner = current_type and 'inner' in current_type.lower()
-                        
-                        if is_inner and layer >= self.start_layer:
-                            # Calculate brick layer Z (half layer height offset)
-                            brick_z = current_z + (layer_height / 2.0)
-                            
-                            # Store transform info keyed by G1 command number
-                            self.transform_map[g1_count] = {
-                                'layer': layer,
-                                'type': current_type,
-                                'offset_state': brick_offset_state,
-                                'current_z': current_z,
-                                'layer_height': layer_height,
-                                'brick_z': brick_z,
-                                'file_line': line_num  # Keep for debugging
-                            }
-                            
-                            if self.verbose and len(self.transform_map) <= 10:
-                                logging.info(f"BrickLayers: Marked G1 command #{g1_count} "
-                                           f"for transformation (file line {line_num}, "
-                                           f"layer {layer}, type: {current_type}, "
-                                           f"Z: {current_z:.3f} -> {brick_z:.3f})")
-            
-            elapsed = time.time() - start_time
-            logging.info(f"BrickLayers: Preprocessing complete in {elapsed:.2f}s")
-            logging.info(f"BrickLayers: Found {g1_count} total G1 commands")
-            logging.info(f"BrickLayers: Marked {len(self.transform_map)} commands for transformation")
-            
-            # Report feature types seen (helpful for debugging)
-            if feature_type_seen:
-                logging.info(f"BrickLayers: Feature types detected:")
-                for ftype, count in sorted(feature_type_seen.items()):
-                    is_inner = 'inner' in ftype.lower()
-                    marker = " <-- WILL TRANSFORM" if is_inner else ""
-                    logging.info(f"  {ftype}: {count} occurrences{marker}")
+            if self.require_comments and not _has_inner_feature(filename):
+                # One search over the file proves the scan would come up
+                # empty, so skip it
+                logging.warning("BrickLayers: No inner perimeter feature "
+                                "types in file! Check that your slicer "
+                                "outputs ;TYPE: comments.")
+                table = TransformTable(extrusion_multiplier)
+            else:
+                # Stream the file in large blocks of raw bytes
+                table, g1_count, feature_type_seen = _scan_gcode(
+                    _read_blocks(filename), self.start_layer,
+                    extrusion_multiplier, self.verbose)
+                
+                elapsed = time.time() - start_time
+                logging.info("BrickLayers: Preprocessing complete in %.2fs",
+                             elapsed)
+                logging.info("BrickLayers: Found %d total G1 commands",
+                             g1_count)
+                logging.info("BrickLayers: Marked %d commands for "
+                             "transformation", len(table))
+                
+                # Report feature types seen (helpful for debugging)
+                if feature_type_seen:
+                    logging.info("BrickLayers: Feature types detected:")
+                    for ftype, count in sorted(feature_type_seen.items()):
+                        marker = (" <-- WILL TRANSFORM"
+                                  if _is_inner_type(ftype) else "")
+                        logging.info("  %s: %d occurrences%s",
+                                     ftype, count, marker)
+                
+                # Warn if no transforms found
+                if not table:
+                    logging.warning("BrickLayers: No inner perimeter moves found! "
+                                  "Check that your slicer outputs ;TYPE: comments.")
+                    if not feature_type_seen:
+                        logging.warning("BrickLayers: No ;TYPE: comments found at all. "
+                                      "Your slicer may not be compatible, or comments may be disabled.")
             
-            # Warn if no transforms found
-            if not self.transform_map:
-                logging.warning("BrickLayers: No inner perimeter moves found! "
-                              "Check that your slicer outputs ;TYPE: comments.")
-                if not feature_type_seen:
-                    logging.warning("BrickLayers: No ;TYPE: comments found at all. "
-                                  "Your slicer may not be compatible, or comments may be disabled.")
+            self._save_cached_table(cache_path, table)
             
         except Exception as e:
-            logging.error(f"BrickLayers: Preprocessing failed: {e}")
-            import traceback
+            logging.error("BrickLayers: Preprocessing failed: %s", e)
             logging.error(traceback.format_exc())
-            self.transform_map = {}
+            table = TransformTable(extrusion_multiplier)
+        
+        self._publish_table(table, generation)
+    
+    def _cache_path(self, filename):
+        """Return the cache file for a G-code file and the current config"""
+        if not self.cache_dir:
+            return None
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        # The extrusion multiplier is not part of the key: a cached table
+        # records its own and is rescaled when published. Neither is
+        # z_offset, which the scan does not use (brick Z is half a layer)
+        key = (f"{_CACHE_VERSION}|{os.path.abspath(filename)}|"
+               f"{st.st_mtime_ns}|{st.st_size}|{self.start_layer}")
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.pkl')
+    
+    def _load_cached_table(self, cache_path):
+        """Load a cached TransformTable, or None on a miss"""
+        if cache_path is None:
+            return None
+        try:
+            with open(cache_path, 'rb') as f:
+                table = pickle.load(f)
+            if not isinstance(table, TransformTable):
+                raise TypeError("not a transform table")
+            # Mark as recently used for LRU eviction
+            os.utime(cache_path)
+            return table
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("BrickLayers: Ignoring unreadable cache %s: %s",
+                            cache_path, e)
+            return None
+    
+    def _save_cached_table(self, cache_path, table):
+        """Store a TransformTable and evict the least recently used entries"""
+        if cache_path is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # A temp file of its own, since scans of the same file can
+            # overlap (a RELOAD during the load-time scan)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                            suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            
+            entries = [os.path.join(self.cache_dir, name)
+                       for name in os.listdir(self.cache_dir)
+                       if name.endswith('.pkl')]
+            entries.sort(key=os.path.getmtime, reverse=True)
+            for stale in entries[_CACHE_MAX_ENTRIES:]:
+                os.remove(stale)
+        except OSError as e:
+            logging.warning("BrickLayers: Could not write cache: %s", e)
     
     def _cmd_G1_wrapper(self, gcmd):
         """Intercept and potentially transform G1 commands"""
         # Increment our command counter
-        self.g1_command_count += 1
-        self.stats_moves_total += 1
+        count = self.g1_command_count + 1
+        self.g1_command_count = count
         
-        # Check if this command should be transformed
-        if self.enabled and self.g1_command_count in self.transform_map:
-            transform_info = self.transform_map[self.g1_command_count]
-            
-            # Update current layer for status reporting
-            if transform_info['layer'] > self.current_layer:
-                self.current_layer = transform_info['layer']
-            
-            # Apply the transformation
-            self._execute_transformed_move(gcmd, transform_info)
-            self.stats_moves_transformed += 1
-            
+        # While disabled only the command count has to stay in step
+        if not self.enabled:
+            self.original_cmd_G1(gcmd)
+            return
+        
+        # Fast path: most moves are not scheduled for transformation, so
+        # pass them straight through without touching their parameters
+        table = self.transform_map
+        if count < table.next_g1:
+            self.original_cmd_G1(gcmd)
+            return
+        row = table.cursor
+        if count == table.next_g1:
+            # The usual hit: step the cursor past this row in line
+            g1_nums = table.g1_nums
+            table.cursor = cursor = row + 1
+            table.next_g1 = (g1_nums[cursor] if cursor < len(g1_nums)
+                             else sys.maxsize)
         else:
-            # Pass through unchanged
-            if self.original_cmd_G1:
+            # Behind after moves that skipped the lookup (disabled)
+            row = table.seek(count)
+            if row < 0:
                 self.original_cmd_G1(gcmd)
-            else:
-                # Fallback: execute as-is
-                self.gcode.run_script_from_command(gcmd.get_command())
-    
-    def _execute_transformed_move(self, gcmd, transform_info):
-        """Execute a G1 move with brick layer transformation applied"""
-        # Extract parameters from original command
-        params = gcmd.get_command_parameters()
+                return
         
-        # Build new command with transformed Z
-        cmd_parts = ['G1']
-        
-        # Add X if present
-        if 'X' in params:
-            cmd_parts.append(f"X{gcmd.get_float('X')}")
-        
-        # Add Y if present
-        if 'Y' in params:
-            cmd_parts.append(f"Y{gcmd.get_float('Y')}")
-        
-        # ALWAYS add/override Z with brick layer height
-        cmd_parts.append(f"Z{transform_info['brick_z']:.6f}")
-        
-        # Add E if present, with multiplier applied
-        if 'E' in params:
-            original_e = gcmd.get_float('E')
-            modified_e = original_e * self.extrusion_multiplier
-            cmd_parts.append(f"E{modified_e:.6f}")
-        
-        # Add F if present
-        if 'F' in params:
-            cmd_parts.append(f"F{gcmd.get_float('F')}")
-        
-        cmd_string = ' '.join(cmd_parts)
+        params = gcmd.get_command_parameters()
         
-        # Log if verbose
+        # Log if verbose (%-style, so formatting is deferred to the handler);
+        # done before the rewrite so the file's own Z is still in params
         if self.verbose:
-            original_z = gcmd.get_float('Z', None)
+            layer = table.layer(row)
+            original_z = params.get('Z')
             if original_z is not None:
-                logging.info(f"BrickLayers: G1 #{self.g1_command_count} - "
-                           f"Layer {transform_info['layer']} ({transform_info['type']}) - "
-                           f"Z: {original_z:.3f} -> {transform_info['brick_z']:.3f}")
+                logging.info("BrickLayers: G1 #%d - Layer %d (%s) - "
+                             "Z: %s -> %s", count, layer,
+                             table.type_name(row), original_z,
+                             table.z_params[row])
+            else:
+                logging.info("BrickLayers: G1 #%d - Layer %d (%s) - "
+                             "Z injected: %s", count, layer,
+                             table.type_name(row), table.z_params[row])
+        
+        # Rewrite Z and E in the command's own parameter dict and hand it
+        # straight to the original G1 handler; X/Y/F are left untouched
+        params['Z'] = table.z_params[row]
+        multiplier = self.extrusion_multiplier
+        if multiplier != 1. and 'E' in params:
+            # E was scaled by the extrusion multiplier during preprocessing;
+            # NaN means the file line had no E, so scale the runtime value.
+            # With a multiplier of 1 the file's own E token is kept as is.
+            extrude = table.e[row]
+            if extrude == extrude:
+                params['E'] = "%.6f" % (extrude,)
             else:
-                logging.info(f"BrickLayers: G1 #{self.g1_command_count} - "
-                           f"Layer {transform_info['layer']} ({transform_info['type']}) - "
-                           f"Z injected: {transform_info['brick_z']:.3f}")
+                try:
+                    params['E'] = "%.6f" % (float(params['E']) * multiplier,)
+                except ValueError:
+                    # Leave a malformed E to the original handler, which
+                    # rejects it as a G-code error
+                    pass
         
-        # Execute the transformed command
         try:
-            self.gcode.run_script(cmd_string)
+            self.original_cmd_G1(gcmd)
         except Exception as e:
-            logging.error(f"BrickLayers: Failed to execute transformed move: {e}")
-            logging.error(f"  Original: {gcmd.get_command()}")
-            logging.error(f"  Transformed: {cmd_string}")
+            logging.error("BrickLayers: Failed to execute transformed move: %s", e)
+            logging.error("  Original: %s", gcmd.get_command())
+            logging.error("  Transformed: %s", params)
+            # Not applied after all; keep it out of the statistics
+            table.skipped += 1
             # Re-raise to prevent silent failures
             raise
 
@@ -1,12 +1,22 @@
 import unittest
 from unittest.mock import MagicMock, patch
 import os
+import shutil
 import sys
+import tempfile
+import threading
 
 # Add the directory containing brick_layers.py to the path
 sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/..'))
 
-from brick_layers import BrickLayers
+import brick_layers
+from brick_layers import BrickLayers, TransformTable
+
+# Options of the mocked config section
+_NO_OPTIONS = {}
+
+_SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'sample_gcode', 'simple.gcode')
 
 class TestBrickLayers(unittest.TestCase):
     def setUp(self):
@@ -17,14 +27,18 @@ class TestBrickLayers(unittest.TestCase):
         self.mock_config.get_printer.return_value = self.mock_printer
         self.mock_printer.lookup_object.side_effect = self.lookup_object_side_effect
         
-        # Default config values
-        self.mock_config.getboolean.side_effect = lambda k, d: d
-        self.mock_config.getfloat.side_effect = lambda k, d: d
-        self.mock_config.getint.side_effect = lambda k, d: d
+        # Default config values: nothing is set, so every getter falls
+        # back to its default (dict.get(key, default) with no keys)
+        for getter in ('getboolean', 'getfloat', 'getint', 'get'):
+            getattr(self.mock_config, getter).side_effect = _NO_OPTIONS.get
         self.mock_config.get_name.return_value = 'brick_layers'
 
         self.bl = BrickLayers(self.mock_config)
         self.bl.gcode = self.mock_gcode
+        self.bl.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.bl.cache_dir, ignore_errors=True)
 
     def lookup_object_side_effect(self, name):
         if name == 'gcode':
@@ -41,94 +55,556 @@ class TestBrickLayers(unittest.TestCase):
         self.assertEqual(self.bl.z_offset, 0.1)
         self.assertEqual(self.bl.start_layer, 3)
         self.assertFalse(self.bl.enabled)
+        # The hot-path objects keep a fixed slot layout, no __dict__
+        self.assertFalse(hasattr(self.bl, '__dict__'))
+        self.assertFalse(hasattr(self.bl.transform_map, '__dict__'))
+
+    def run_g1(self, params):
+        """Feed a single G1 through the wrapper, return the params it ran"""
+        self.bl.original_cmd_G1 = MagicMock()
+        params = {k: str(v) for k, v in params.items()}
+        gcmd = MagicMock()
+        gcmd.get_command_parameters.return_value = params
+        self.bl._cmd_G1_wrapper(gcmd)
+        self.bl.original_cmd_G1.assert_called_once_with(gcmd)
+        # Parameters are read from the dict, never through get_float()
+        self.assertLessEqual(gcmd.get_command_parameters.call_count, 1)
+        gcmd.get_float.assert_not_called()
+        return {k: float(v) for k, v in params.items()}
+
+    def make_table(self, g1_num, brick_z=0.3, e=0.105):
+        table = TransformTable()
+        table.add(g1_num, brick_z, e, 1, True, 'Inner wall')
+        return table
 
     def test_preprocess_simple_gcode(self):
-        sample_path = os.path.abspath(os.path.dirname(__file__) + '/sample_gcode/simple.gcode')
         self.bl.start_layer = 1 # Start early for testing
-        self.bl._preprocess_gcode_file(sample_path)
+        self.bl._preprocess_gcode_file(_SAMPLE)
         
         # Check if we found transform points
-        # In simple.gcode:
-        # Layer 1 (0.2): Internal moves lines 12-16
-        # Layer 2 (0.4): Internal moves lines 27-31
-        
-        # Wait, let's check line numbers exactly.
+        # Transform points are keyed by G1 command number (not file line),
+        # since that is what we count at runtime.
         # Line 1: ; simple.gcode
         # Line 2: G28
         # Line 3: ;LAYER_CHANGE
         # Line 4: ;Z:0.2 (Layer 1)
         # Line 5: ;TYPE:External perimeter
-        # Line 6: G1 X0 Y0 Z0.2 E0 F3000
-        # Line 7: G1 X10 Y0 E0.5
-        # Line 8: G1 X10 Y10 E1.0
-        # Line 9: G1 X0 Y10 E1.5
-        # Line 10: G1 X0 Y0 E2.0
+        # Line 6: G1 X0 Y0 Z0.2 E0 F3000    (G1 #1)
+        # Line 7: G1 X10 Y0 E0.5            (G1 #2)
+        # Line 8: G1 X10 Y10 E1.0           (G1 #3)
+        # Line 9: G1 X0 Y10 E1.5            (G1 #4)
+        # Line 10: G1 X0 Y0 E2.0            (G1 #5)
         # Line 11: ;TYPE:Inner wall
-        # Line 12: G1 X1 Y1 E2.1  <- Transform!
-        # Line 13: G1 X9 Y1 E2.6  <- Transform!
-        # Line 14: G1 X9 Y9 E3.1  <- Transform!
-        # Line 15: G1 X1 Y9 E3.6  <- Transform!
-        # Line 16: G1 X1 Y1 E4.1  <- Transform!
+        # Line 12: G1 X1 Y1 E2.1  <- Transform! (G1 #6)
+        # Line 13: G1 X9 Y1 E2.6  <- Transform! (G1 #7)
+        # Line 14: G1 X9 Y9 E3.1  <- Transform! (G1 #8)
+        # Line 15: G1 X1 Y9 E3.6  <- Transform! (G1 #9)
+        # Line 16: G1 X1 Y1 E4.1  <- Transform! (G1 #10)
         # Line 17: ;LAYER_CHANGE
         # Line 18: ;Z:0.4 (Layer 2)
         # ...
+        # Line 27: G1 X9 Y1 E6.7  <- Transform! (G1 #17)
+        
+        self.assertIn(6, self.bl.transform_map)
+        self.assertNotIn(5, self.bl.transform_map)
+        info = self.bl.transform_map[6]
+        self.assertEqual(info.layer, 1)
+        self.assertEqual(info.offset_state, True) # layer 1 >= start_layer 1
+        self.assertEqual(info.type, 'Inner wall')
+        self.assertAlmostEqual(info.brick_z, 0.3)
+        
+        self.assertIn(17, self.bl.transform_map)
+        info = self.bl.transform_map[17]
+        self.assertEqual(info.layer, 2)
+        self.assertEqual(info.offset_state, False) # layer 2 toggles it
+        self.assertAlmostEqual(info.brick_z, 0.5)
+        
+        # Rows live in typed arrays; the only per-row references are to
+        # one shared Z string per layer
+        table = self.bl.transform_map
+        for name in ('g1_nums', 'e'):
+            self.assertIsInstance(getattr(table, name), brick_layers.array.array)
+        self.assertEqual(len(set(map(id, table.z_params))), 2)
+        # Layers (with their offset state) and feature types are kept
+        # once per run of rows
+        self.assertEqual(list(table.layer_rows), [0, 5])
+        self.assertEqual(list(table.layer_offsets), [1, 0])
+        self.assertEqual(list(table.type_rows), [0])
+        self.assertEqual(table.type_name(7), 'Inner wall')
+
+    def test_preprocess_verbose(self):
+        self.bl.start_layer = 2
+        self.bl.verbose = True
+        with self.assertLogs(level='INFO') as logs:
+            self.bl._preprocess_gcode_file(_SAMPLE)
+        self.assertEqual(len(self.bl.transform_map), 5)
+        self.assertTrue(any('Marked G1 command #16' in line
+                            for line in logs.output))
+
+    def test_scan_skips_g10_g11(self):
+        lines = [b';LAYER_CHANGE', b';TYPE:Inner wall', b'G1 X1 Y1 E1',
+                 b'G10', b'G11', b'G1X2 Y2 E2']
+        table, g1_count, _ = brick_layers._scan_gcode(
+            [b'\n'.join(lines)], 1, 1., False)
+        # Firmware retracts do not reach the G1 wrapper, so not counted
+        self.assertEqual(g1_count, 2)
+        self.assertEqual(list(table.keys()), [1, 2])
+
+    def test_scan_z_words(self):
+        lines = [b';LAYER_CHANGE', b';HEIGHT:0.2', b';TYPE:Inner wall',
+                 b'G1 Z0.4 E1', b'G1 X1 Z0.6F600 E2', b'G1 Z E3',
+                 b'G1 X2 Z-0.2 ; Z9', b'G1 X3 E4', b'G10', b'G1 X4 E5']
+        table, g1_count, _ = brick_layers._scan_gcode(
+            [b'\n'.join(lines)], 1, 1., False)
+        # Packed and empty Z words fall back to the regex
+        self.assertEqual([round(table[n].brick_z, 3) for n in range(1, 7)],
+                         [0.5, 0.7, 0.7, -0.1, -0.1, -0.1])
+        # The moves after the last Z word are taken as one run
+        self.assertEqual(g1_count, 6)
+        self.assertEqual(list(table.e[4:]), [4., 5.])
+        
+        # A packed E word is not an exponent of the Z value
+        lines = [b';LAYER_CHANGE', b';HEIGHT:0.2', b';TYPE:Inner wall',
+                 b'G1 X1 Z1E2', b'G1X1Y1Z0.4E-1']
+        table, _, _ = brick_layers._scan_gcode(
+            [b'\n'.join(lines)], 1, 1., False)
+        self.assertEqual([round(table[n].brick_z, 3) for n in (1, 2)],
+                         [1.1, 0.5])
+
+    def test_scan_e_words(self):
+        lines = [b';LAYER_CHANGE', b';TYPE:Inner wall', b'G1 X1 E0.5',
+                 b'G1 X2 ; E9', b'G1 E Y2 E1.5', b'G1 X3 F600']
+        table, _, _ = brick_layers._scan_gcode(
+            [b'\n'.join(lines)], 1, 1., False)
+        # A bare E word is skipped in favour of a later one
+        self.assertEqual(table.e[0], 0.5)
+        self.assertNotEqual(table.e[1], table.e[1])
+        self.assertEqual(table.e[2], 1.5)
+        self.assertNotEqual(table.e[3], table.e[3])
+
+    def test_scan_marker_styles(self):
+        # Cura-style layer and feature markers, PrusaSlicer-style height
+        lines = [b';LAYER:0', b';HEIGHT:0.3', b';TYPE:WALL-INNER',
+                 b'G1 Z0.3 E1', b';LAYER:1', b';TYPE:WALL-OUTER',
+                 b'G1 X1 E2', b'  ;TYPE:WALL-INNER', b'G1 X2 E3',
+                 b';TYPE:Inner wall', b'G1 X3 E4']
+        table, g1_count, seen = brick_layers._scan_gcode(
+            [b'\n'.join(lines)], 1, 1., False)
+        self.assertEqual(g1_count, 4)
+        self.assertEqual(list(table.keys()), [1, 3, 4])
+        self.assertAlmostEqual(table[3].brick_z, 0.45)
+        self.assertEqual(table[3].layer, 2)
+        self.assertNotEqual(table[1].offset_state, table[3].offset_state)
+        self.assertEqual(seen, {'WALL-INNER': 2, 'WALL-OUTER': 1,
+                                'Inner wall': 1})
+        self.assertEqual([table[n].type for n in (1, 3, 4)],
+                         ['WALL-INNER', 'WALL-INNER', 'Inner wall'])
+
+    def test_scan_bulk_counts(self):
+        # Outside transformed features G1s are counted in bulk
+        gcode = (b';LAYER_CHANGE\n;TYPE:Inner wall\nG1 X1 E1 ; Z9\n'
+                 b'G10\nG1 Z0.6\n  G1 X2\n;LAYER_CHANGE\n;Z:0.8\n'
+                 b'G1 Z1.0 ;TYPE:Skirt\n;TYPE:Inner wall\nG1 X3 E2')
+        table, g1_count, _ = brick_layers._scan_gcode([gcode], 2, 1., False)
+        self.assertEqual(g1_count, 5)
+        # A marker token after a move is not a marker
+        self.assertEqual(list(table.keys()), [4, 5])
+        self.assertAlmostEqual(table[5].brick_z, 1.1)
+        self.assertEqual(table[5].e, 2.0)
+        self.assertEqual(table.z_params[1], table.z_params[0])
+
+        table, g1_count, _ = brick_layers._scan_gcode([gcode], 3, 1., False)
+        self.assertEqual(g1_count, 5)
+        self.assertFalse(table)
+        
+        # The Z of an untransformed span is still read word by word
+        gcode = (b';LAYER_CHANGE\n;HEIGHT:0.2\n;TYPE:Skirt\nG1 X1 Z1E2\n'
+                 b'G1 X2 E3\n;TYPE:Inner wall\nG1 X3 E4')
+        table, _, _ = brick_layers._scan_gcode([gcode], 1, 1., False)
+        self.assertEqual(list(table.keys()), [3])
+        self.assertAlmostEqual(table[3].brick_z, 1.1)
+
+    def test_preprocess_skips_files_without_inner_walls(self):
+        path = os.path.join(self.bl.cache_dir, 'outer.gcode')
+        with open(path, 'w') as f:
+            f.write(';LAYER_CHANGE\n;TYPE:External perimeter\nG1 X1 E1\n')
+        with patch.object(brick_layers, '_scan_gcode') as scan:
+            self.bl._preprocess_gcode_file(path)
+            scan.assert_not_called()
+        self.assertFalse(self.bl.transform_map)
+
+        # Any letter case counts as an inner wall type (Cura style here)
+        with open(path, 'a') as f:
+            f.write(';TYPE:WALL-INNER\nG1 X2 E2\n')
+        self.assertTrue(brick_layers._has_inner_feature(path))
+
+    def test_read_blocks_chunk_boundaries(self):
+        with open(_SAMPLE, 'rb') as f:
+            expected = f.read()
+        # Tiny chunks force many blocks; each must end on a line
+        with patch.object(brick_layers, '_READ_CHUNK_SIZE', 7):
+            blocks = list(brick_layers._read_blocks(_SAMPLE))
+        self.assertGreater(len(blocks), 1)
+        self.assertTrue(all(block.endswith(b'\n') for block in blocks))
+        self.assertEqual(b''.join(blocks), expected)
+
+        # Files that cannot be memory-mapped are read in blocks instead
+        with patch.object(brick_layers, '_READ_CHUNK_SIZE', 7), \
+                patch.object(brick_layers.mmap, 'mmap', side_effect=OSError):
+            blocks = list(brick_layers._read_blocks(_SAMPLE))
+            self.assertTrue(brick_layers._has_inner_feature(_SAMPLE))
+        self.assertTrue(all(block.endswith(b'\n') for block in blocks))
+        self.assertEqual(b''.join(blocks), expected)
+
+    def test_preprocess_extrusion_multiplier(self):
+        self.bl.start_layer = 1
+        self.bl.extrusion_multiplier = 1.1
+        self.bl._preprocess_gcode_file(_SAMPLE)
+        
+        # Line 12: G1 X1 Y1 E2.1 -> E pre-multiplied during preprocessing
+        self.assertAlmostEqual(self.bl.transform_map[6].e, 2.1 * 1.1)
+
+    def test_preprocess_cache(self):
+        self.bl.start_layer = 1
+        self.bl._preprocess_gcode_file(_SAMPLE)
+        self.assertEqual(len(os.listdir(self.bl.cache_dir)), 1)
+        
+        # Second load of the unchanged file is served from the cache
+        with patch.object(BrickLayers, '_save_cached_table') as save:
+            self.bl._preprocess_gcode_file(_SAMPLE)
+            save.assert_not_called()
+        self.assertEqual(list(self.bl.transform_map.keys()),
+                         [6, 7, 8, 9, 10, 16, 17, 18, 19, 20])
+        
+        # A new extrusion multiplier reuses the entry, rescaled
+        self.bl.extrusion_multiplier = 1.2
+        with patch.object(BrickLayers, '_save_cached_table') as save:
+            self.bl._preprocess_gcode_file(_SAMPLE)
+            save.assert_not_called()
+        self.assertAlmostEqual(self.bl.transform_map[6].e, 2.1 * 1.2)
+        
+        # So does a new z_offset, which the scan does not use
+        self.bl.z_offset = 0.2
+        with patch.object(BrickLayers, '_save_cached_table') as save:
+            self.bl._preprocess_gcode_file(_SAMPLE)
+            save.assert_not_called()
+        
+        # A config change that affects the result misses the cache
+        self.bl.start_layer = 2
+        self.bl._preprocess_gcode_file(_SAMPLE)
+        self.assertEqual(list(self.bl.transform_map.keys()),
+                         [16, 17, 18, 19, 20])
+        
+        # An entry holding anything but a table is rescanned
+        with open(self.bl._cache_path(_SAMPLE), 'wb') as f:
+            brick_layers.pickle.dump({6: None}, f)
+        self.bl._preprocess_gcode_file(_SAMPLE)
+        self.assertEqual(list(self.bl.transform_map.keys()),
+                         [16, 17, 18, 19, 20])
+
+    def test_cache_write_uses_own_temp_file(self):
+        cache_path = os.path.join(self.bl.cache_dir, 'entry.pkl')
+        mkstemp = brick_layers.tempfile.mkstemp
+        with patch.object(brick_layers.tempfile, 'mkstemp',
+                          side_effect=mkstemp) as make_temp:
+            self.bl._save_cached_table(cache_path, self.make_table(3))
+        # A fresh temp file per write, so overlapping scans of one file
+        # never write into the same one
+        make_temp.assert_called_once_with(dir=self.bl.cache_dir,
+                                          suffix='.tmp')
+        self.assertEqual(os.listdir(self.bl.cache_dir), ['entry.pkl'])
+        self.assertIn(3, self.bl._load_cached_table(cache_path))
+        
+        # A failed write leaves neither a temp file nor a partial entry
+        os.remove(cache_path)
+        with patch.object(brick_layers.pickle, 'dump',
+                          side_effect=OSError('disk full')):
+            self.bl._save_cached_table(cache_path, self.make_table(3))
+        self.assertEqual(os.listdir(self.bl.cache_dir), [])
+
+    def test_enable_rescales_extrusion(self):
+        self.bl.start_layer = 1
+        self.bl.sdcard = None
+        self.bl._preprocess_gcode_file(_SAMPLE)
         
-        self.assertIn(12, self.bl.transform_map)
-        self.assertEqual(self.bl.transform_map[12]['layer'], 1)
-        self.assertEqual(self.bl.transform_map[12]['offset_state'], True) # layer 1 >= start_layer 1
+        gcmd = MagicMock()
+        gcmd.get_float.side_effect = lambda k, d, above=None: 1.2
+        self.bl.cmd_ENABLE(gcmd)
         
-        self.assertIn(27, self.bl.transform_map)
-        self.assertEqual(self.bl.transform_map[27]['layer'], 2)
-        self.assertEqual(self.bl.transform_map[27]['offset_state'], False) # layer 2 toggles it
+        self.assertTrue(self.bl.enabled)
+        self.assertEqual(self.bl.extrusion_multiplier, 1.2)
+        # Line 12: G1 X1 Y1 E2.1 -> rescaled without a rescan
+        self.assertAlmostEqual(self.bl.transform_map[6].e, 2.1 * 1.2)
+
+    def test_enable_preprocesses_in_background(self):
+        self.bl.start_layer = 1
+        self.bl.sdcard = MagicMock()
+        self.bl.sdcard.file_path.return_value = _SAMPLE
+        threads = []
+        def scan(filename, generation, use_cache):
+            threads.append(threading.current_thread())
+            self.bl._preprocess_done.set()
+        with patch.object(BrickLayers, '_preprocess_gcode_file',
+                          side_effect=scan):
+            self.bl.cmd_ENABLE(MagicMock(**{'get_float.return_value': 1.05}))
+            self.assertTrue(self.bl._preprocess_done.wait(5))
+        # Scanned on the worker thread, not inside the command
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+        self.assertEqual(self.bl.last_preprocessed_file, _SAMPLE)
+
+    def test_moves_total_counts_enabled_moves(self):
+        self.bl.g1_command_count = 10
+        self.bl.cmd_ENABLE(MagicMock(**{'get_float.return_value': 1.05}))
+        self.bl.g1_command_count = 25
+        self.bl.cmd_DISABLE(MagicMock())
+        self.bl.g1_command_count = 40
+        self.assertEqual(self.bl.stats_moves_total, 15)
+        self.bl.cmd_ENABLE(MagicMock(**{'get_float.return_value': 1.05}))
+        self.bl.g1_command_count = 42
+        self.assertEqual(self.bl.stats_moves_total, 17)
+
+    def test_background_preprocess(self):
+        self.bl.start_layer = 1
+        self.bl._start_preprocessing(_SAMPLE)
+        self.assertTrue(self.bl._preprocess_done.wait(5))
+        self.assertFalse(self.bl._preprocess_running())
+        self.assertIn(6, self.bl.transform_map)
+
+    def test_enable_mid_print_keeps_count(self):
+        # The scan at load time came up empty; ENABLE rescans mid-print
+        self.bl.start_layer = 1
+        self.bl.sdcard = MagicMock()
+        self.bl.sdcard.file_path.return_value = _SAMPLE
+        self.bl.g1_command_count = 7
+        self.bl.cmd_ENABLE(MagicMock(**{'get_float.return_value': 1.05}))
+        self.assertTrue(self.bl._preprocess_done.wait(5))
+        
+        # Rows stay in step with the moves already executed
+        self.assertEqual(self.bl.g1_command_count, 7)
+        params = self.run_g1({'X': 9, 'Y': 9, 'E': 3.1})
+        self.assertAlmostEqual(params['Z'], 0.3)
+        self.assertEqual(self.bl.stats_moves_transformed, 1)
+
+    def test_superseded_scan_not_published(self):
+        self.bl._preprocess_generation = 2
+        self.bl._preprocess_done.clear()
+        self.bl._publish_table(self.make_table(6), 1)
+        # Neither installed nor taken as the newer scan finishing
+        self.assertFalse(self.bl.transform_map)
+        self.assertTrue(self.bl._preprocess_running())
+        
+        self.bl._publish_table(self.make_table(7), 2)
+        self.assertIn(7, self.bl.transform_map)
+        self.assertFalse(self.bl._preprocess_running())
+
+    def test_work_handler_detects_new_file(self):
+        self.bl.sdcard = MagicMock()
+        self.bl.sdcard.file_path.return_value = '/tmp/a.gcode'
+        self.bl.original_work_handler = MagicMock(return_value=0.)
+        with patch.object(BrickLayers, '_start_preprocessing') as start:
+            self.bl._work_handler_wrapper(1.)
+            self.bl._work_handler_wrapper(2.)
+            start.assert_called_once_with('/tmp/a.gcode')
+        self.assertEqual(self.bl.original_work_handler.call_count, 2)
+
+    def test_work_handler_restarts_same_file(self):
+        self.bl.enabled = True
+        self.bl.transform_map = self.make_table(3)
+        self.bl.last_preprocessed_file = '/tmp/a.gcode'
+        self.bl.sdcard = MagicMock()
+        self.bl.sdcard.file_path.return_value = '/tmp/a.gcode'
+        self.bl.original_work_handler = MagicMock(return_value=0.)
+        for _ in range(5):
+            self.run_g1({'X': 1, 'E': 1})
+        
+        with patch.object(BrickLayers, '_start_preprocessing') as start:
+            # Resuming after a pause carries on counting
+            self.bl.sdcard.file_position = 1234
+            self.bl._work_handler_wrapper(1.)
+            self.assertEqual(self.bl.g1_command_count, 5)
+            
+            # Cancelled (the file stays loaded) and printed again: the
+            # table is kept but applied from the start
+            self.bl.sdcard.file_position = 0
+            self.bl._work_handler_wrapper(2.)
+            start.assert_not_called()
+        self.assertEqual(self.bl.g1_command_count, 0)
+        self.assertEqual(self.bl.stats_moves_transformed, 0)
+        self.run_g1({'X': 1, 'E': 1})
+        self.run_g1({'X': 1, 'E': 1})
+        params = self.run_g1({'X': 1, 'E': 1})
+        self.assertAlmostEqual(params['Z'], 0.3)
+        self.assertEqual(self.bl.stats_moves_transformed, 1)
+
+    def test_reload_in_background(self):
+        self.bl.start_layer = 1
+        self.bl.sdcard = MagicMock()
+        self.bl.sdcard.file_path.return_value = _SAMPLE
+        self.bl.cmd_RELOAD(MagicMock())
+        self.assertTrue(self.bl._preprocess_done.wait(5))
+        self.assertIn(6, self.bl.transform_map)
+        
+        # A reload rescans even with a cached table, and replaces it
+        with open(self.bl._cache_path(_SAMPLE), 'wb') as f:
+            brick_layers.pickle.dump(self.make_table(3), f)
+        with patch.object(BrickLayers, '_load_cached_table') as load:
+            self.bl.cmd_RELOAD(MagicMock())
+            self.assertTrue(self.bl._preprocess_done.wait(5))
+            load.assert_not_called()
+        self.assertIn(6, self.bl.transform_map)
+        self.assertNotIn(3, self.bl.transform_map)
+        table = self.bl._load_cached_table(self.bl._cache_path(_SAMPLE))
+        self.assertIn(6, table)
+
+    def test_status_upcoming(self):
+        self.bl.verbose = True
+        for g1_num in range(10, 80, 10):
+            self.bl.transform_map.add(g1_num, 0.3, None, 2, True, 'Inner wall')
+        self.bl.g1_command_count = 20
+        gcmd = MagicMock()
+        self.bl.cmd_STATUS(gcmd)
+        gcmd.respond_info.assert_called_with(
+            "  Next transforms at G1 commands: [30, 40, 50, 60, 70]")
 
     def test_apply_transform_z(self):
-        self.bl.current_gcode_line = 12
+        self.bl.enabled = True
+        self.bl.g1_command_count = 11
         # New behavior: brick_z is pre-calculated during preprocessing
-        self.bl.transform_map = {12: {
-            'layer': 1,
-            'offset_state': True,
-            'current_z': 0.2,
-            'layer_height': 0.2,
-            'brick_z': 0.3  # 0.2 + 0.2/2 = 0.3 (half layer higher)
-        }}
+        self.bl.transform_map = self.make_table(12)
         self.bl.z_offset = 0.1
 
-        params = {'X': 1, 'Y': 1, 'Z': 0.2, 'E': 0.1, 'F': None}
-        transformed = self.bl._apply_transform(params)
+        transformed = self.run_g1({'X': 1, 'Y': 1, 'Z': 0.2, 'E': 0.1})
 
         self.assertAlmostEqual(transformed['Z'], 0.3) # brick_z value
+        self.assertEqual(self.bl.stats_moves_transformed, 1)
         
+    def test_failed_move_not_counted(self):
+        self.bl.enabled = True
+        self.bl.g1_command_count = 11
+        self.bl.transform_map = self.make_table(12)
+        self.bl.original_cmd_G1 = MagicMock(side_effect=ValueError('boom'))
+        gcmd = MagicMock()
+        gcmd.get_command_parameters.return_value = {'X': '1', 'E': '0.1'}
+
+        with self.assertLogs(level='ERROR'):
+            with self.assertRaises(ValueError):
+                self.bl._cmd_G1_wrapper(gcmd)
+        self.assertEqual(self.bl.stats_moves_transformed, 0)
+
     def test_apply_transform_z_injection(self):
         """Test that Z is injected even when not originally present"""
-        self.bl.current_gcode_line = 12
-        self.bl.transform_map = {12: {
-            'layer': 1,
-            'offset_state': True,
-            'current_z': 0.2,
-            'layer_height': 0.2,
-            'brick_z': 0.3  # 0.2 + 0.2/2 = 0.3
-        }}
+        self.bl.enabled = True
+        self.bl.g1_command_count = 11
+        self.bl.transform_map = self.make_table(12)
 
         # Original move has NO Z parameter
-        params = {'X': 1, 'Y': 1, 'Z': None, 'E': 0.1, 'F': None}
-        transformed = self.bl._apply_transform(params)
+        transformed = self.run_g1({'X': 1, 'Y': 1, 'E': 0.1})
 
         # Z should be injected!
         self.assertAlmostEqual(transformed['Z'], 0.3)
 
     def test_apply_transform_e(self):
-        self.bl.current_gcode_line = 12
-        self.bl.transform_map = {12: {
-            'layer': 1,
-            'offset_state': True,
-            'brick_z': 0.3
-        }}
-        self.bl.extrusion_multiplier = 1.1
+        self.bl.enabled = True
+        self.bl.g1_command_count = 11
+        self.bl.transform_map = self.make_table(12, e=1.1)
 
-        params = {'X': 1, 'Y': 1, 'Z': 0.2, 'E': 1.0, 'F': None}
-        transformed = self.bl._apply_transform(params)
+        transformed = self.run_g1({'X': 1, 'Y': 1, 'Z': 0.2, 'E': 1.0})
 
         self.assertAlmostEqual(transformed['E'], 1.1)
+        # Rewritten in place, never re-dispatched as G-code text
+        self.mock_gcode.run_script.assert_not_called()
+        self.mock_gcode.run_script_from_command.assert_not_called()
+
+        # No E in the file line: the runtime E is scaled, and a malformed
+        # one is left for the original handler to reject
+        self.bl.transform_map = self.make_table(13, e=None)
+        transformed = self.run_g1({'X': 1, 'E': 2.0})
+        self.assertAlmostEqual(transformed['E'], 2.1)
+        self.bl.transform_map = self.make_table(14, e=None)
+        self.bl.original_cmd_G1 = MagicMock()
+        params = {'X': '1', 'E': 'bad'}
+        gcmd = MagicMock()
+        gcmd.get_command_parameters.return_value = params
+        self.bl._cmd_G1_wrapper(gcmd)
+        self.assertEqual(params['E'], 'bad')
+        self.bl.original_cmd_G1.assert_called_once_with(gcmd)
+
+    def test_apply_transform_e_unscaled(self):
+        self.bl.enabled = True
+        self.bl.extrusion_multiplier = 1.
+        self.bl.original_cmd_G1 = MagicMock()
+        self.bl.transform_map = self.make_table(1, e=1.)
+        params = {'X': '1', 'E': '1.00000'}
+        gcmd = MagicMock()
+        gcmd.get_command_parameters.return_value = params
+
+        self.bl._cmd_G1_wrapper(gcmd)
+
+        # The original E token is passed through untouched
+        self.assertEqual(params['E'], '1.00000')
+        self.assertAlmostEqual(float(params['Z']), 0.3)
+        # Z is the string formatted during preprocessing, not a new one
+        self.assertIs(params['Z'], self.bl.transform_map.z_params[0])
+
+    def test_passthrough_untransformed(self):
+        self.bl.enabled = True
+        self.bl.transform_map = self.make_table(12, e=1.1)
+
+        passed = self.run_g1({'X': 1, 'Y': 1, 'E': 1.0})
+
+        self.assertEqual(passed, {'X': 1.0, 'Y': 1.0, 'E': 1.0})
+        self.assertEqual(self.bl.stats_moves_transformed, 0)
+
+        # Pass-through moves never have their parameters extracted
+        gcmd = MagicMock()
+        self.bl._cmd_G1_wrapper(gcmd)
+        gcmd.get_command_parameters.assert_not_called()
+        gcmd.get_float.assert_not_called()
+        self.bl.original_cmd_G1.assert_called_with(gcmd)
+
+        # Past the end of the table (e.g. moves from end G-code macros)
+        self.bl.g1_command_count = 100
+        passed = self.run_g1({'X': 2, 'Y': 2})
+        self.assertEqual(passed, {'X': 2.0, 'Y': 2.0})
+
+    def test_passthrough_empty_table(self):
+        # Enabled before (or without) a scan result: one compare per move
+        self.bl.enabled = True
+        self.assertEqual(self.bl.transform_map.next_g1, sys.maxsize)
+        gcmd = MagicMock()
+        self.bl.original_cmd_G1 = MagicMock()
+        self.bl._cmd_G1_wrapper(gcmd)
+        gcmd.get_command_parameters.assert_not_called()
+        self.bl.original_cmd_G1.assert_called_once_with(gcmd)
+        self.assertEqual(self.bl.stats_moves_total, 1)
+
+    def test_cursor_catches_up(self):
+        table = self.make_table(12)
+        table.add(15, 0.5, None, 2, False, 'Inner wall')
+        self.bl.transform_map = table
+        self.bl.enabled = True
+        # G1 #12 ran while disabled and was never looked up
+        self.bl.g1_command_count = 13
+
+        passed = self.run_g1({'X': 1, 'Y': 1})
+        self.assertEqual(passed, {'X': 1.0, 'Y': 1.0})
+
+        transformed = self.run_g1({'X': 1, 'Y': 1})
+        self.assertAlmostEqual(transformed['Z'], 0.5)
+        self.assertEqual(table.cursor, 2)
+        self.assertEqual(self.bl.current_layer, 2)
+
+    def test_passthrough_disabled(self):
+        self.bl.g1_command_count = 11
+        self.bl.transform_map = self.make_table(12)
+
+        passed = self.run_g1({'X': 1, 'Y': 1, 'Z': 0.2, 'E': 0.1})
+
+        # The command count keeps advancing; the move stats do not
+        self.assertEqual(passed, {'X': 1.0, 'Y': 1.0, 'Z': 0.2, 'E': 0.1})
+        self.assertEqual(self.bl.g1_command_count, 12)
+        self.assertEqual(self.bl.stats_moves_total, 0)
 
 if __name__ == '__main__':
     unittest.main()